@@ -2,19 +2,31 @@
 """
 batch_download_datasets.py
 批量下载所有组织的数据集，调用 hf_download.py
-- 下载完成后删除 --local-dir 文件夹，只保留 --cache-dir
+- 使用 --skip-local-copy 只写 --cache-dir，不产生本地副本
 - 当 ./hf_cache 超过 10TB 时发送企业微信通知
 """
 
 import json
+import pickle
+import signal
 import subprocess
 import sys
 import os
-import shutil
+import threading
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import orjson  # C 实现，大列表序列化比标准库 json 快数倍
+except ImportError:
+    orjson = None
+
+
+def _json_loads(text):
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
 # ========== 配置区 ==========
 DOWNLOAD_SCRIPT = "./scripts/download.py"
 CACHE_DIR = "./hf_cache"
@@ -22,6 +34,12 @@ LOCAL_DIR_ROOT = "./hf_datasets"
 TOKEN = None  # HF Token，如需私有数据集请填写
 DATASET_IDS_FILE = "./scripts/all_dataset_ids.json"
 
+# 进度改用 append-only 日志：每个数据集成功后 O(1) 追加一行，
+# 不再每次全量重写 JSON；崩溃也不会留下截断的 JSON
+PROGRESS_LOG = "download_progress.log"
+LEGACY_PROGRESS_JSON = "download_progress.json"
+PROGRESS_COMPACT_EVERY = 1000  # 每追加 N 条压缩一次（去重重写）
+
 # 企业微信 Webhook
 NODE = "Adrastea" # Adrastea or Pear
 WECHAT_WEBHOOK_URL = "https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=d8255c93-2896-4736-988e-ec0782aff888"
@@ -29,22 +47,81 @@ WECHAT_WEBHOOK_URL = "https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=d8255
 # 缓存空间阈值：10TB = 10 * 1024^4 bytes
 CACHE_SIZE_THRESHOLD = 10 * (1024 ** 4)
 
+# 并发下载的数据集数量
+PARALLEL_DOWNLOADS = int(os.environ.get("BAYES_HUB_PARALLEL", "4"))
+
 # 是否已发送过超阈值通知（运行期间只发一次）
 _threshold_notified = False
+
+# 保护进度文件和计数器的并发写入
+_progress_lock = threading.Lock()
+
+# 每个顶层子目录的大小缓存：path -> (mtime, size)
+# 避免每个数据集下载后都重新遍历整个 10TB 缓存
+SIZE_CACHE_FILE = "cache_size_cache.pkl"
+SIZE_RESEED_EVERY = 50  # 每 N 次检查强制全量重算，纠正 mtime 检测不到的深层变化
+_size_cache = {}
+_size_check_count = 0
 # ============================
 
 
+def _scandir_size(path):
+    """迭代式 scandir 遍历计算目录大小（字节）
+
+    DirEntry 缓存了 stat 结果，每个文件只需一次 stat 系统调用。
+    显式栈避免深层目录递归。
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        p = stack.pop()
+        try:
+            with os.scandir(p) as it:
+                for entry in it:
+                    try:
+                        if entry.is_symlink():
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError as e:
+            print(f"[!] 计算目录大小出错: {e}")
+    return total
+
+
 def get_dir_size(path):
-    """递归计算目录大小（字节）"""
+    """递归计算目录大小（字节），按顶层子目录并行遍历
+
+    单线程遍历受 I/O 延迟限制，高 IOPS 存储上并行读目录
+    能按并行度近线性加速。
+    """
     total = 0
+    subdirs = []
     try:
-        for dirpath, dirnames, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                if os.path.isfile(fp) and not os.path.islink(fp):
-                    total += os.path.getsize(fp)
-    except Exception as e:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError as e:
         print(f"[!] 计算目录大小出错: {e}")
+        return total
+
+    if not subdirs:
+        return total
+
+    workers = min(32, (os.cpu_count() or 8) * 4, len(subdirs))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        total += sum(ex.map(_scandir_size, subdirs))
     return total
 
 
@@ -83,9 +160,53 @@ def send_wechat_notification(message):
         print(f"[!] 发送企业微信通知出错: {e}")
 
 
+def get_cache_size_cached(cache_path, force_rescan=False):
+    """按顶层子目录缓存大小，只重算 mtime 变化（或未见过）的子目录"""
+    global _size_cache
+
+    if not _size_cache and os.path.exists(SIZE_CACHE_FILE):
+        try:
+            with open(SIZE_CACHE_FILE, "rb") as f:
+                _size_cache = pickle.load(f)
+        except Exception:
+            _size_cache = {}
+
+    total = 0
+    seen = set()
+    try:
+        with os.scandir(cache_path) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+                    continue
+                seen.add(entry.path)
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+                cached = _size_cache.get(entry.path)
+                if cached is not None and cached[0] == mtime and not force_rescan:
+                    total += cached[1]
+                else:
+                    size = get_dir_size(entry.path)
+                    _size_cache[entry.path] = (mtime, size)
+                    total += size
+    except OSError as e:
+        print(f"[!] 计算目录大小出错: {e}")
+
+    # 清理已删除的子目录，并持久化，重启后免去首次全量遍历
+    _size_cache = {k: v for k, v in _size_cache.items() if k in seen}
+    try:
+        with open(SIZE_CACHE_FILE, "wb") as f:
+            pickle.dump(_size_cache, f)
+    except Exception:
+        pass
+
+    return total
+
+
 def check_cache_size_and_notify():
     """检查缓存目录大小，超过阈值则发送通知"""
-    global _threshold_notified
+    global _threshold_notified, _size_check_count
     if _threshold_notified:
         return
 
@@ -93,7 +214,9 @@ def check_cache_size_and_notify():
     if not os.path.exists(cache_path):
         return
 
-    size = get_dir_size(cache_path)
+    _size_check_count += 1
+    force = (_size_check_count % SIZE_RESEED_EVERY == 0)
+    size = get_cache_size_cached(cache_path, force_rescan=force)
     size_str = format_size(size)
     print(f"[*] 当前缓存大小: {size_str}")
 
@@ -109,14 +232,14 @@ def check_cache_size_and_notify():
         print(f"[!] 缓存已超过 10TB，已发送通知")
 
 
-def download_dataset(dataset_id, cache_dir, local_dir, token=None):
-    """调用 hf_download.py 下载单个数据集"""
+def download_dataset(dataset_id, cache_dir, token=None):
+    """调用 hf_download.py 下载单个数据集（只写缓存，不落本地副本）"""
     cmd = [
         sys.executable, DOWNLOAD_SCRIPT,
         dataset_id,
         "--repo-type", "dataset",
         "--cache-dir", cache_dir,
-        "--local-dir", local_dir,
+        "--skip-local-copy",
     ]
 
     if token:
@@ -124,7 +247,6 @@ def download_dataset(dataset_id, cache_dir, local_dir, token=None):
 
     print(f"\n{'='*60}")
     print(f"[*] 开始下载数据集: {dataset_id}")
-    print(f"[*] 本地目录: {local_dir}")
     print(f"{'='*60}")
 
     try:
@@ -143,24 +265,30 @@ def download_dataset(dataset_id, cache_dir, local_dir, token=None):
         return False
 
 
-def remove_local_dir(local_dir):
-    """下载完成后删除 local-dir 文件夹，只保留 cache-dir"""
-    if os.path.exists(local_dir):
+def load_completed():
+    """读取进度日志（兼容旧版 download_progress.json）"""
+    completed = set()
+    if os.path.exists(LEGACY_PROGRESS_JSON):
         try:
-            shutil.rmtree(local_dir)
-            print(f"[+] 已删除本地目录: {local_dir}")
-
-            # 清理空的父目录
-            parent = os.path.dirname(local_dir)
-            while parent and parent != os.path.abspath(LOCAL_DIR_ROOT):
-                if os.path.isdir(parent) and not os.listdir(parent):
-                    os.rmdir(parent)
-                    print(f"[+] 已删除空父目录: {parent}")
-                    parent = os.path.dirname(parent)
-                else:
-                    break
+            with open(LEGACY_PROGRESS_JSON, "r") as f:
+                completed.update(_json_loads(f.read()))
         except Exception as e:
-            print(f"[!] 删除本地目录失败 {local_dir}: {e}")
+            print(f"[!] 读取旧版进度文件失败: {e}")
+    if os.path.exists(PROGRESS_LOG):
+        with open(PROGRESS_LOG, "r", encoding="utf-8") as f:
+            completed.update(line.strip() for line in f if line.strip())
+    return completed
+
+
+def compact_progress_log(completed):
+    """去重重写进度日志，原子替换"""
+    tmp = PROGRESS_LOG + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for ds in sorted(completed):
+            f.write(ds + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, PROGRESS_LOG)
 
 
 def main():
@@ -177,75 +305,99 @@ def main():
 
     # 读取数据集列表
     with open(DATASET_IDS_FILE, "r", encoding="utf-8") as f:
-        all_datasets = json.load(f)
+        all_datasets = _json_loads(f.read())
 
     total = sum(len(v) for v in all_datasets.values())
     print(f"[*] 共需下载 {total} 个数据集")
     print(f"[*] 缓存目录: {os.path.abspath(CACHE_DIR)}")
-    print(f"[*] 本地临时目录: {os.path.abspath(LOCAL_DIR_ROOT)}")
     print(f"[*] 缓存阈值: {format_size(CACHE_SIZE_THRESHOLD)}")
 
     # 加载已完成列表（支持断点续传）
-    progress_file = "download_progress.json"
-    completed = set()
-    if os.path.exists(progress_file):
-        with open(progress_file, "r") as f:
-            completed = set(json.load(f))
+    completed = load_completed()
+    if completed:
         print(f"[*] 已完成 {len(completed)} 个数据集，跳过")
 
+    # 旧版 JSON 一次性迁移进日志后删除
+    if os.path.exists(LEGACY_PROGRESS_JSON):
+        compact_progress_log(completed)
+        os.remove(LEGACY_PROGRESS_JSON)
+        print(f"[*] 已迁移旧版进度文件到 {PROGRESS_LOG}")
+
+    progress_log = open(PROGRESS_LOG, "a", encoding="utf-8")
+    appends_since_compact = 0
+
     success_count = 0
     fail_count = 0
     skip_count = 0
     failed_datasets = []
 
-    current = 0
+    # 展平 (org, dataset_id) 列表，跳过已完成的
+    pending = []
     for org, dataset_ids in all_datasets.items():
         print(f"\n{'#'*60}")
         print(f"# 组织: {org} ({len(dataset_ids)} 个数据集)")
         print(f"{'#'*60}")
-
         for dataset_id in dataset_ids:
-            current += 1
-
-            # 跳过已完成的
             if dataset_id in completed:
                 skip_count += 1
-                print(f"\n>>> 进度: {current}/{total} — 跳过已完成: {dataset_id}")
-                continue
-
-            print(f"\n>>> 进度: {current}/{total}")
-
-            local_dir = os.path.join(
-                LOCAL_DIR_ROOT,
-                dataset_id.replace("/", os.sep)
-            )
-
-            # ---- 下载 ----
-            ok = download_dataset(
-                dataset_id=dataset_id,
-                cache_dir=CACHE_DIR,
-                local_dir=local_dir,
-                token=TOKEN,
-            )
-
-            # ---- 下载完成后删除 local-dir ----
-            if ok:
-                success_count += 1
-                remove_local_dir(local_dir)
-
-                # 记录已完成
-                completed.add(dataset_id)
-                with open(progress_file, "w") as f:
-                    json.dump(list(completed), f)
+                print(f">>> 跳过已完成: {dataset_id}")
             else:
-                fail_count += 1
-                failed_datasets.append(dataset_id)
-                # 即使失败也清理临时目录
-                remove_local_dir(local_dir)
+                pending.append(dataset_id)
+
+    print(f"\n[*] 待下载 {len(pending)} 个数据集，并发数: {PARALLEL_DOWNLOADS}")
+
+    def _download_one(dataset_id):
+        return download_dataset(
+            dataset_id=dataset_id,
+            cache_dir=CACHE_DIR,
+            token=TOKEN,
+        )
+
+    current = 0
+    with ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOADS) as ex:
+        # Ctrl-C 时取消未开始的任务
+        def _handle_sigint(signum, frame):
+            print(f"\n[!] 收到中断信号，取消剩余任务...")
+            ex.shutdown(wait=False, cancel_futures=True)
+            sys.exit(1)
+
+        signal.signal(signal.SIGINT, _handle_sigint)
+
+        futures = {ex.submit(_download_one, ds): ds for ds in pending}
+        for fut in as_completed(futures):
+            dataset_id = futures[fut]
+            current += 1
+            print(f"\n>>> 进度: {current}/{len(pending)} — {dataset_id}")
+
+            try:
+                ok = fut.result()
+            except Exception as e:
+                print(f"[!] 数据集 {dataset_id} 下载出错: {e}")
+                ok = False
+
+            with _progress_lock:
+                if ok:
+                    success_count += 1
+                    # O(1) 追加记录已完成，fsync 保证崩溃后不丢
+                    completed.add(dataset_id)
+                    progress_log.write(dataset_id + "\n")
+                    progress_log.flush()
+                    os.fsync(progress_log.fileno())
+                    appends_since_compact += 1
+                    if appends_since_compact >= PROGRESS_COMPACT_EVERY:
+                        progress_log.close()
+                        compact_progress_log(completed)
+                        progress_log = open(PROGRESS_LOG, "a", encoding="utf-8")
+                        appends_since_compact = 0
+                else:
+                    fail_count += 1
+                    failed_datasets.append(dataset_id)
 
             # ---- 检查缓存大小并通知 ----
             check_cache_size_and_notify()
 
+    progress_log.close()
+
     # ---- 打印汇总 ----
     print(f"\n{'='*60}")
     print(f"下载完成!")
@@ -264,7 +416,10 @@ def main():
             print(f"  - {ds}")
 
         with open("./scripts/failed_datasets.json", "w", encoding="utf-8") as f:
-            json.dump(failed_datasets, f, indent=2)
+            if orjson is not None:
+                f.write(orjson.dumps(failed_datasets, option=orjson.OPT_INDENT_2).decode())
+            else:
+                json.dump(failed_datasets, f, indent=2)
         print(f"\n失败列表已保存到 failed_datasets.json")
 
     # 清理空的临时根目录
@@ -11,16 +11,22 @@ Example:
     ./hf_cache/cas-bridge.xethub.hf.co/xet-bridge-us/621ffdc.../abc123....sha256
 """
 import os
+import re
 import sys
 import csv
+import fnmatch
+import functools
+import json
 import hashlib
 import shutil
+import sqlite3
 import argparse
 import requests
-import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
-from urllib.parse import urlparse
+from urllib.parse import quote
 
 project_root = str(Path(__file__).resolve().parent.parent)
 if project_root not in sys.path:
@@ -29,18 +35,234 @@ if project_root not in sys.path:
 import huggingface_hub
 from huggingface_hub import HfApi, hf_hub_url
 
+try:
+    import hf_transfer
+except ImportError:
+    hf_transfer = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 MAPPING_CSV = "model_cache_mapping.csv"
+CACHE_INDEX_DB = "cache_index.sqlite"
 HF_ENDPOINT = os.environ.get("HF_ENDPOINT", "https://huggingface.co")
+PARALLEL_WORKERS = int(os.environ.get("HF_PARALLEL_DOWNLOADING_WORKERS", "8"))
+
+# Sidecar extension follows the hash in use; both are accepted on reads
+# so caches written before/after installing blake3 stay valid.
+HASH_SIDECAR_EXT = ".blake3" if blake3 is not None else ".sha256"
+HASH_SIDECAR_EXTS = (".blake3", ".sha256")
+
+_thread_local = threading.local()
+
+
+def _new_hash():
+    """Fastest available integrity hash: multi-threaded BLAKE3 if installed,
+    otherwise SHA-256."""
+    if blake3 is not None:
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.sha256()
+
+
+def _has_hash_sidecar(cache_file_path):
+    return any(os.path.exists(cache_file_path + ext) for ext in HASH_SIDECAR_EXTS)
+
+
+def _fast_copy(src, dst):
+    """Copy src to dst with os.copy_file_range when available (in-kernel
+    copy, O(1) reflink on XFS/Btrfs), falling back to a buffered copy."""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        if hasattr(os, "copy_file_range"):
+            try:
+                size = os.fstat(s.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(s.fileno(), d.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied >= size:
+                    return
+            except OSError:
+                pass
+            s.seek(0)
+            d.seek(0)
+            d.truncate()
+        shutil.copyfileobj(s, d, 1024 * 1024)
+
+
+def _get_session():
+    """Per-thread requests.Session so TCP/TLS connections are reused."""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=requests.adapters.Retry(total=5, backoff_factor=0.5),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _thread_local.session = session
+    return session
+
+
+def _get_cache_index(cache_root):
+    """Per-thread SQLite connection to the cache index.
+
+    Hit detection becomes an in-process B-tree lookup instead of two
+    stat() syscalls per file on warm-cache reruns.
+    """
+    conn = getattr(_thread_local, "index_conn", None)
+    if conn is None:
+        conn = sqlite3.connect(os.path.join(cache_root, CACHE_INDEX_DB))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files("
+            "domain TEXT, path TEXT, hash TEXT, size INT, mtime REAL, "
+            "PRIMARY KEY(domain, path))"
+        )
+        _thread_local.index_conn = conn
+    return conn
+
+
+def _index_lookup(cache_root, domain, path):
+    try:
+        row = _get_cache_index(cache_root).execute(
+            "SELECT 1 FROM files WHERE domain=? AND path=?", (domain, path)
+        ).fetchone()
+        return row is not None
+    except sqlite3.Error:
+        return False
+
+
+def _index_delete(cache_root, domain, path):
+    """Drop a stale index row whose file no longer exists on disk."""
+    try:
+        conn = _get_cache_index(cache_root)
+        conn.execute("DELETE FROM files WHERE domain=? AND path=?", (domain, path))
+        conn.commit()
+    except sqlite3.Error:
+        pass
+
+
+def _index_record(cache_root, domain, path, file_hash, cache_file_path):
+    try:
+        st = os.stat(cache_file_path)
+        conn = _get_cache_index(cache_root)
+        conn.execute(
+            "INSERT OR REPLACE INTO files(domain, path, hash, size, mtime) "
+            "VALUES(?, ?, ?, ?, ?)",
+            (domain, path, file_hash, st.st_size, st.st_mtime),
+        )
+        conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"[!] Cache index update failed: {e}")
 
 
-def calculate_sha256(file_path):
-    h = hashlib.sha256()
+@functools.lru_cache(maxsize=None)
+def _url_stem(repo_id, repo_type, revision):
+    """Resolved-URL prefix for a repo; hf_hub_url's formatting/validation
+    runs once per (repo_id, repo_type, revision) instead of once per file."""
+    stem = hf_hub_url(
+        repo_id=repo_id, filename="_PLACEHOLDER_", repo_type=repo_type, revision=revision
+    )
+    return stem.split("_PLACEHOLDER_")[0]
+
+
+def _hf_file_url(repo_id, filename, repo_type, revision):
+    return _url_stem(repo_id, repo_type, revision) + quote(filename)
+
+
+def _fsync_dir(dir_path):
+    fd = os.open(dir_path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _durable_rename(tmp_path, final_path):
+    """Crash-safe publish: fsync the data, rename, fsync the parent dir.
+
+    Without this, a crash can leave the data file visible but the hash
+    sidecar missing, so the cache-hit check fails and a multi-GB shard
+    gets re-downloaded.
+    """
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, final_path)
+    _fsync_dir(os.path.dirname(final_path))
+
+
+def _durable_write(path, text):
+    """Write small metadata (hash sidecars) via tmp + fsync + rename."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+def _write_meta(meta_file_path, commit_hash, linked_etag, linked_size):
+    meta = {"commit_hash": commit_hash, "linked_etag": linked_etag, "linked_size": linked_size}
+    if orjson is not None:
+        with open(meta_file_path, "wb") as f:
+            f.write(orjson.dumps(meta))
+    else:
+        with open(meta_file_path, "w") as f:
+            json.dump(meta, f)
+
+
+def _fadvise(fd, advice):
+    """Best-effort page-cache hint; a no-op where unsupported."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+
+def _drop_page_cache(file_path):
+    """Tell the kernel a freshly written file won't be re-read soon, so a
+    multi-GB shard doesn't evict hotter pages on the cache host."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _fadvise(fd, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def calculate_file_hash(file_path):
+    h = _new_hash()
     with open(file_path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            _fadvise(f.fileno(), os.POSIX_FADV_SEQUENTIAL)
         while True:
             chunk = f.read(1024 * 1024)
             if not chunk:
                 break
             h.update(chunk)
+        if hasattr(os, "posix_fadvise"):
+            _fadvise(f.fileno(), os.POSIX_FADV_DONTNEED)
     return h.hexdigest()
 
 
@@ -49,14 +271,14 @@ def get_lfs_redirect_info(repo_id, filename, repo_type="model", revision="main",
     Get the LFS redirect URL and metadata for a file.
     Returns: (lfs_url, commit_hash, linked_etag, linked_size)
     """
-    url = hf_hub_url(repo_id=repo_id, filename=filename, repo_type=repo_type, revision=revision)
+    url = _hf_file_url(repo_id, filename, repo_type, revision)
     
     headers = {}
     if token:
         headers["Authorization"] = f"Bearer {token}"
     
     try:
-        resp = requests.head(url, headers=headers, allow_redirects=False, timeout=30)
+        resp = _get_session().head(url, headers=headers, allow_redirects=False, timeout=30)
         if resp.status_code == 302:
             return (
                 resp.headers.get("Location"),
@@ -76,13 +298,13 @@ def parse_lfs_url(lfs_url):
     Example: https://cas-bridge.xethub.hf.co/xet-bridge-us/621ffdc.../abc123...?query=...
     Returns: (cas-bridge.xethub.hf.co, xet-bridge-us/621ffdc.../abc123...)
     """
-    if not lfs_url:
+    if not lfs_url or "://" not in lfs_url:
         return None, None
-    
-    parsed = urlparse(lfs_url)
-    domain = parsed.netloc
-    path = parsed.path.lstrip("/")
-    return domain, path
+
+    # str.split beats urlparse here: the hot per-file path only needs
+    # netloc + path, not full URL normalization
+    domain, _, rest = lfs_url.split("://", 1)[1].partition("/")
+    return domain, rest.split("?", 1)[0]
 
 
 def download_and_cache_lfs(lfs_url, cache_root, commit_hash=None, linked_etag=None, 
@@ -97,15 +319,22 @@ def download_and_cache_lfs(lfs_url, cache_root, commit_hash=None, linked_etag=No
         return None
     
     cache_file_path = os.path.join(cache_root, domain, url_path)
-    sha256_file_path = cache_file_path + ".sha256"
+    hash_file_path = cache_file_path + HASH_SIDECAR_EXT
     meta_file_path = cache_file_path + ".meta"
-    
-    if os.path.exists(cache_file_path) and os.path.exists(sha256_file_path):
+
+    if _index_lookup(cache_root, domain, url_path):
+        # The proxy's janitor (or manual cleanup) may have evicted the blob
+        # since it was indexed; one stat guards against trusting a stale row.
+        if os.path.exists(cache_file_path):
+            print(f"[=] Already cached (indexed): {domain}/{url_path[:50]}...")
+            return cache_file_path
+        _index_delete(cache_root, domain, url_path)
+
+    if os.path.exists(cache_file_path) and _has_hash_sidecar(cache_file_path):
         print(f"[=] Already cached: {domain}/{url_path[:50]}...")
+        _index_record(cache_root, domain, url_path, None, cache_file_path)
         if commit_hash and not os.path.exists(meta_file_path):
-            import json
-            with open(meta_file_path, "w") as f:
-                json.dump({"commit_hash": commit_hash, "linked_etag": linked_etag, "linked_size": linked_size}, f)
+            _write_meta(meta_file_path, commit_hash, linked_etag, linked_size)
         return cache_file_path
     
     os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
@@ -113,30 +342,67 @@ def download_and_cache_lfs(lfs_url, cache_root, commit_hash=None, linked_etag=No
     temp_path = cache_file_path + ".tmp"
     
     print(f"[*] Downloading LFS: {domain}/{url_path[:50]}...")
-    
-    cmd = ["curl", "-L", "-s", "-o", temp_path, lfs_url]
-    result = subprocess.run(cmd, timeout=3600)
-    
-    if result.returncode != 0 or not os.path.exists(temp_path):
-        print(f"[!] Failed to download: {lfs_url[:100]}...")
-        return None
-    
-    sha256_hash = calculate_sha256(temp_path)
-    
-    os.rename(temp_path, cache_file_path)
-    with open(sha256_file_path, "w") as f:
-        f.write(sha256_hash)
-    
+
+    file_hash = None
+
+    if hf_transfer is not None:
+        # Multi-connection range download saturates bandwidth on one file
+        try:
+            hf_transfer.download(
+                url=lfs_url,
+                filename=temp_path,
+                max_files=1,
+                chunk_size=10 * 1024 * 1024,
+                parallel_failures=3,
+                max_retries=5,
+            )
+        except Exception as e:
+            print(f"[!] hf_transfer failed ({e}), falling back to streaming download")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    if not os.path.exists(temp_path):
+        # Hash while streaming so the file is not re-read afterwards.
+        # Read into one preallocated buffer instead of letting iter_content
+        # allocate a fresh bytes object per chunk.
+        try:
+            h = _new_hash()
+            buf = bytearray(8 * 1024 * 1024)
+            view = memoryview(buf)
+            with _get_session().get(lfs_url, stream=True, timeout=(10, 300)) as resp:
+                resp.raise_for_status()
+                with open(temp_path, "wb") as f:
+                    while True:
+                        n = resp.raw.readinto(view)
+                        if not n:
+                            break
+                        f.write(view[:n])
+                        h.update(view[:n])
+            file_hash = h.hexdigest()
+        except Exception as e:
+            print(f"[!] Failed to download: {lfs_url[:100]}... ({e})")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+
+    if file_hash is None:
+        # hf_transfer path: file already on disk, hash it after the fact
+        file_hash = calculate_file_hash(temp_path)
+
+    _durable_rename(temp_path, cache_file_path)
+    _durable_write(hash_file_path, file_hash)
+
+    _index_record(cache_root, domain, url_path, file_hash, cache_file_path)
+    _drop_page_cache(cache_file_path)
+
     if commit_hash:
-        import json
-        with open(meta_file_path, "w") as f:
-            json.dump({"commit_hash": commit_hash, "linked_etag": linked_etag, "linked_size": linked_size}, f)
+        _write_meta(meta_file_path, commit_hash, linked_etag, linked_size)
     
-    print(f"[+] Cached: {domain}/{url_path[:50]}... (sha256: {sha256_hash[:16]}...)")
+    print(f"[+] Cached: {domain}/{url_path[:50]}... (hash: {file_hash[:16]}...)")
     
     if local_file_path:
         os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-        shutil.copy2(cache_file_path, local_file_path)
+        _fast_copy(cache_file_path, local_file_path)
         print(f"[+] Copied to: {local_file_path}")
     
     return cache_file_path
@@ -145,7 +411,7 @@ def download_and_cache_lfs(lfs_url, cache_root, commit_hash=None, linked_etag=No
 def download_small_file(repo_id, filename, cache_root, repo_type="model", revision="main", 
                         token=None, local_file_path=None):
     """Download non-LFS (small) file directly."""
-    url = hf_hub_url(repo_id=repo_id, filename=filename, repo_type=repo_type, revision=revision)
+    url = _hf_file_url(repo_id, filename, repo_type, revision)
     
     headers = {}
     if token:
@@ -153,33 +419,44 @@ def download_small_file(repo_id, filename, cache_root, repo_type="model", revisi
     
     cache_dir = os.path.join(cache_root, "small_files", repo_id.replace("/", "--"))
     os.makedirs(cache_dir, exist_ok=True)
-    
+
     temp_path = os.path.join(cache_dir, filename + ".tmp")
     cache_file_path = os.path.join(cache_dir, filename)
-    
+
+    index_path = repo_id.replace("/", "--") + "/" + filename
+    if _index_lookup(cache_root, "small_files", index_path) and os.path.exists(cache_file_path):
+        print(f"[=] Already cached (indexed): {filename}")
+        if local_file_path:
+            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+            _fast_copy(cache_file_path, local_file_path)
+        return cache_file_path
+
     os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-    
+
     print(f"[*] Downloading small file: {filename}")
     
     try:
-        resp = requests.get(url, headers=headers, stream=True, timeout=300)
+        resp = _get_session().get(url, headers=headers, stream=True, timeout=300)
         resp.raise_for_status()
-        
+
+        h = _new_hash()
         with open(temp_path, "wb") as f:
             for chunk in resp.iter_content(chunk_size=1024*1024):
                 f.write(chunk)
-        
-        sha256_hash = calculate_sha256(temp_path)
-        
-        os.rename(temp_path, cache_file_path)
-        with open(cache_file_path + ".sha256", "w") as f:
-            f.write(sha256_hash)
-        
-        print(f"[+] Downloaded: {filename} (sha256: {sha256_hash[:16]}...)")
+                h.update(chunk)
+
+        file_hash = h.hexdigest()
+
+        _durable_rename(temp_path, cache_file_path)
+        _durable_write(cache_file_path + HASH_SIDECAR_EXT, file_hash)
+
+        _index_record(cache_root, "small_files", index_path, file_hash, cache_file_path)
+
+        print(f"[+] Downloaded: {filename} (hash: {file_hash[:16]}...)")
         
         if local_file_path:
             os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-            shutil.copy2(cache_file_path, local_file_path)
+            _fast_copy(cache_file_path, local_file_path)
         
         return cache_file_path
     except Exception as e:
@@ -226,6 +503,8 @@ def main():
     parser.add_argument("--revision", default="main", help="Specific branch/tag/commit")
     parser.add_argument("--include", nargs="+", help="Patterns for files to include")
     parser.add_argument("--exclude", nargs="+", help="Patterns for files to exclude")
+    parser.add_argument("--skip-local-copy", action="store_true",
+                        help="Only populate the cache, never copy files into --local-dir")
     
     args = parser.parse_args()
 
@@ -248,50 +527,59 @@ def main():
             token=args.token
         )
         
+        # Compile each pattern list into one union regex: a single match
+        # per filename instead of O(files x patterns) fnmatch calls.
         if args.include:
-            import fnmatch
-            filtered = []
-            for f in files:
-                for pattern in args.include:
-                    if fnmatch.fnmatch(f, pattern):
-                        filtered.append(f)
-                        break
-            files = filtered
-        
+            include_re = re.compile("|".join(fnmatch.translate(p) for p in args.include))
+            files = [f for f in files if include_re.match(f)]
+
         if args.exclude:
-            import fnmatch
-            filtered = []
-            for f in files:
-                excluded = False
-                for pattern in args.exclude:
-                    if fnmatch.fnmatch(f, pattern):
-                        excluded = True
-                        break
-                if not excluded:
-                    filtered.append(f)
-            files = filtered
+            exclude_re = re.compile("|".join(fnmatch.translate(p) for p in args.exclude))
+            files = [f for f in files if not exclude_re.match(f)]
         
         print(f"[*] Total files to download: {len(files)}")
-        
-        cache_dirs = set()
-        
-        for filename in files:
-            local_file_path = None
-            if args.local_dir:
-                local_file_path = os.path.join(os.path.abspath(args.local_dir), filename)
-            
-            lfs_url, commit_hash, linked_etag, linked_size = get_lfs_redirect_info(
+
+        # One batched paths-info call tells us which files are LFS, so
+        # regular files skip the per-file HEAD round-trip entirely.
+        lfs_files = None
+        try:
+            paths_info = api.get_paths_info(
                 repo_id=args.repo_id,
-                filename=filename,
+                paths=files,
                 repo_type=args.repo_type,
                 revision=args.revision,
                 token=args.token
             )
-            
+            lfs_files = {p.path for p in paths_info if getattr(p, "lfs", None)}
+            print(f"[*] LFS files: {len(lfs_files)}/{len(files)}")
+        except Exception as e:
+            print(f"[!] get_paths_info failed ({e}), falling back to per-file HEAD")
+
+        cache_dirs = set()
+        cache_dirs_lock = threading.Lock()
+
+        def _fetch(filename):
+            local_file_path = None
+            if args.local_dir and not args.skip_local_copy:
+                local_file_path = os.path.join(os.path.abspath(args.local_dir), filename)
+
+            if lfs_files is not None and filename not in lfs_files:
+                # Known non-LFS file: no redirect to resolve
+                lfs_url = commit_hash = linked_etag = linked_size = None
+            else:
+                # LFS (or unknown): HEAD for the signed redirect URL
+                lfs_url, commit_hash, linked_etag, linked_size = get_lfs_redirect_info(
+                    repo_id=args.repo_id,
+                    filename=filename,
+                    repo_type=args.repo_type,
+                    revision=args.revision,
+                    token=args.token
+                )
+
             if lfs_url:
                 cache_path = download_and_cache_lfs(
-                    lfs_url, cache_root, 
-                    commit_hash=commit_hash, 
+                    lfs_url, cache_root,
+                    commit_hash=commit_hash,
                     linked_etag=linked_etag,
                     linked_size=linked_size,
                     local_file_path=local_file_path
@@ -299,7 +587,8 @@ def main():
                 if cache_path:
                     domain, _ = parse_lfs_url(lfs_url)
                     if domain:
-                        cache_dirs.add(os.path.join(cache_root, domain))
+                        with cache_dirs_lock:
+                            cache_dirs.add(os.path.join(cache_root, domain))
             else:
                 cache_path = download_small_file(
                     repo_id=args.repo_id,
@@ -311,8 +600,17 @@ def main():
                     local_file_path=local_file_path
                 )
                 if cache_path:
-                    cache_dirs.add(os.path.dirname(cache_path))
-        
+                    with cache_dirs_lock:
+                        cache_dirs.add(os.path.dirname(cache_path))
+
+        with ThreadPoolExecutor(max_workers=PARALLEL_WORKERS) as ex:
+            futures = {ex.submit(_fetch, f): f for f in files}
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                except Exception as e:
+                    print(f"[!] Error downloading {futures[fut]}: {e}")
+
         update_mapping_csv(cache_root, args.repo_id, args.repo_type, list(cache_dirs), args.revision)
         
         print(f"[+] Download complete!")
@@ -4,9 +4,16 @@ fetch_dataset_ids.py
 获取指定组织在 Hugging Face 上的所有 dataset ID
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 from huggingface_hub import HfApi
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 orgs = [
     "nvidia",
     "google",
@@ -19,23 +26,33 @@ orgs = [
 ]
 
 api = HfApi()
-all_datasets = {}
 
-for org in orgs:
-    print(f"\n[*] 正在获取 {org} 的数据集列表...")
+
+def fetch_org(org):
+    """获取单个组织的数据集 ID 列表，失败返回空列表"""
+    print(f"[*] 正在获取 {org} 的数据集列表...")
     try:
-        datasets = list(api.list_datasets(author=org))
-        dataset_ids = [ds.id for ds in datasets]
-        all_datasets[org] = dataset_ids
-        print(f"[+] {org}: 找到 {len(dataset_ids)} 个数据集")
-        for ds_id in dataset_ids:
-            print(f"    - {ds_id}")
+        return [ds.id for ds in api.list_datasets(author=org)]
     except Exception as e:
         print(f"[!] 获取 {org} 数据集失败: {e}")
-        all_datasets[org] = []
+        return []
+
+
+# 各组织的列表请求互不依赖，并行发出
+with ThreadPoolExecutor(max_workers=len(orgs)) as ex:
+    all_datasets = dict(zip(orgs, ex.map(fetch_org, orgs)))
+
+for org, dataset_ids in all_datasets.items():
+    print(f"\n[+] {org}: 找到 {len(dataset_ids)} 个数据集")
+    for ds_id in dataset_ids:
+        print(f"    - {ds_id}")
 
-with open("all_dataset_ids.json", "w", encoding="utf-8") as f:
-    json.dump(all_datasets, f, indent=2, ensure_ascii=False)
+if orjson is not None:
+    with open("all_dataset_ids.json", "wb") as f:
+        f.write(orjson.dumps(all_datasets, option=orjson.OPT_INDENT_2))
+else:
+    with open("all_dataset_ids.json", "w", encoding="utf-8") as f:
+        json.dump(all_datasets, f, indent=2, ensure_ascii=False)
 
 total = sum(len(v) for v in all_datasets.values())
 print(f"\n[+] 总计: {total} 个数据集")
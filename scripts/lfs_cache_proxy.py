@@ -1,18 +1,69 @@
 import os
+import re
 import hashlib
+import logging
+import logging.handlers
+import mmap
+import queue
 import requests
-import subprocess
+import sqlite3
 import threading
-from flask import Flask, request, Response, stream_with_context
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, Response, send_file, stream_with_context
+from werkzeug.wsgi import wrap_file
 from urllib.parse import urlparse, parse_qs, urlencode
 
 app = Flask(__name__)
 
+# 日志经 QueueHandler 入队、后台 QueueListener 落盘：
+# 请求线程不再阻塞在 stdout 的写锁上。默认 WARNING，排障时调低
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler())
+_log_listener.start()
+log = logging.getLogger("lfs_cache_proxy")
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.setLevel(os.environ.get("LOG_LEVEL", "WARNING").upper())
+
 CACHE_ROOT = os.environ.get("CACHE_ROOT", "./hf_cache")
 OUTBOUND_PROXY = os.environ.get("OUTBOUND_PROXY", "http://127.0.0.1:6666")  # 可以设为空来测试
 
-download_locks = threading.Lock()
-active_downloads = set()
+# 上游流式读取块大小：256 KiB 以上 HTTP 分块开销基本持平，
+# 更小的块减少每次 yield 前的等待
+UPSTREAM_CHUNK = int(os.environ.get("UPSTREAM_CHUNK", 256 * 1024))
+# 本地磁盘顺序读块大小：4 MiB 左右吞吐最佳，摊薄 syscall 开销
+LOCAL_CHUNK = int(os.environ.get("LOCAL_CHUNK", 4 * 1024 * 1024))
+
+# 设置后把缓存命中交给前置 nginx 直接发文件（internal location 前缀），
+# Python 进程只做路由，数据不再经过解释器
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX", "")
+# 设置后全量响应走纯 Python 生成器而不是 send_file（调试 / 无 sendfile 的环境）
+SERVE_FULL_PY = bool(os.environ.get("SERVE_FULL_PY"))
+
+# 后台下载线程池：限制并发数，避免无界线程把磁盘打满
+_dl_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("DL_WORKERS", "8")))
+
+# 正在后台下载的 local_path -> Future
+# dict 的单次操作在 GIL 下是原子的，热路径上无需加锁
+_inflight = {}
+
+# 后台下载专用长连接会话：省掉每个文件 fork curl + 重新 TLS 握手
+_bg_session = requests.Session()
+_bg_adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64)
+_bg_session.mount("https://", _bg_adapter)
+_bg_session.mount("http://", _bg_adapter)
+
+# 前台透传专用会话：每请求新建连接的 TLS 握手在高并发下占大头，
+# 连接池复用 + 少量带退避的重试吸收上游抖动
+_up_session = requests.Session()
+_up_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=256,
+    max_retries=requests.adapters.Retry(total=3, backoff_factor=0.3),
+)
+_up_session.mount("https://", _up_adapter)
+_up_session.mount("http://", _up_adapter)
 
 # 禁用 SSL 警告（仅用于调试）
 import urllib3
@@ -36,24 +87,24 @@ def get_xethub_cache_path(domain, path):
     cache_key_path = os.path.join(domain, path)
     return os.path.join(CACHE_ROOT, cache_key_path)
 
+# 转发时需要剔除的头：frozenset 成员判断 O(1)，在模块级只构造一次
+_SKIP_REQ_HEADERS = frozenset({'host', 'content-length', 'transfer-encoding'})
+_SKIP_RESP_HEADERS = frozenset({'content-encoding', 'transfer-encoding', 'connection'})
+
 def proxy_to_upstream_with_cache(real_url, method, local_cache_path=None):
     """代理到上游，可选地缓存响应内容"""
     try:
         # 构建转发的 headers
-        skip_headers = ['host', 'content-length', 'transfer-encoding']
-        headers = {}
-        
-        for k, v in request.headers.items():
-            if k.lower() not in skip_headers:
-                headers[k] = v
-        
+        headers = {k: v for k, v in request.headers.items()
+                   if k.lower() not in _SKIP_REQ_HEADERS}
+
         parsed = urlparse(real_url)
         headers['Host'] = parsed.netloc
         
-        print(f"[*] [LFS] Direct proxy to: {real_url[:100]}...")
-        print(f"[DEBUG] Method: {method}")
+        log.info("[LFS] Direct proxy to: %s...", real_url[:100])
+        log.debug("Method: %s", method)
         
-        up_resp = requests.request(
+        up_resp = _up_session.request(
             method=method,
             url=real_url, 
             proxies=get_proxies(), 
@@ -64,22 +115,26 @@ def proxy_to_upstream_with_cache(real_url, method, local_cache_path=None):
             allow_redirects=False
         )
         
-        print(f"[DEBUG] Upstream status: {up_resp.status_code}")
+        log.debug("Upstream status: %s", up_resp.status_code)
         
         # 如果上游返回重定向
         if up_resp.status_code in [301, 302, 303, 307, 308]:
             location = up_resp.headers.get('Location', '')
-            print(f"[DEBUG] Redirect to: {location[:100]}...")
-        
-        excluded_headers = ['content-encoding', 'transfer-encoding', 'connection']
-        resp_headers = [(name, value) for (name, value) in up_resp.raw.headers.items()
-                        if name.lower() not in excluded_headers]
+            log.debug("Redirect to: %s...", location[:100])
         
+        resp_headers = []
+        cl_present = False
+        for name, value in up_resp.raw.headers.items():
+            lower = name.lower()
+            if lower in _SKIP_RESP_HEADERS:
+                continue
+            cl_present = cl_present or lower == 'content-length'
+            resp_headers.append((name, value))
+
         if method == 'HEAD':
             resp = Response(status=up_resp.status_code, headers=resp_headers)
-            if 'content-length' not in [h[0].lower() for h in resp_headers]:
-                cl = up_resp.headers.get('Content-Length', '0')
-                resp.headers['Content-Length'] = cl
+            if not cl_present:
+                resp.headers['Content-Length'] = up_resp.headers.get('Content-Length', '0')
             return resp
 
         # GET 请求：如果需要缓存，边下载边写入缓存文件
@@ -87,14 +142,12 @@ def proxy_to_upstream_with_cache(real_url, method, local_cache_path=None):
             return stream_and_cache_response(up_resp, resp_headers, local_cache_path)
         
         return Response(
-            stream_with_context(up_resp.iter_content(chunk_size=1024*1024)), 
+            stream_with_context(up_resp.iter_content(chunk_size=UPSTREAM_CHUNK)), 
             status=up_resp.status_code, 
             headers=resp_headers
         )
     except Exception as e:
-        print(f"[ERROR] Proxy failed: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Proxy failed: %s", real_url[:100])
         return str(e), 502
 
 def stream_and_cache_response(up_resp, resp_headers, local_cache_path):
@@ -103,27 +156,57 @@ def stream_and_cache_response(up_resp, resp_headers, local_cache_path):
     temp_path = local_cache_path + ".tmp"
     
     def generate_and_cache():
-        h = hashlib.sha256()
+        # 哈希挪到后台线程：响应路径只剩 write + yield，
+        # 客户端带宽不再被 hash 计算卡住。有界队列提供背压。
+        hq = queue.Queue(maxsize=8)
+        digest_holder = []
+        content_length = up_resp.headers.get('Content-Length')
+        h = _SampledHasher(int(content_length) if content_length else None)
+
+        def _hasher():
+            while True:
+                block = hq.get()
+                if block is None:
+                    break
+                h.update(block)
+            digest_holder.append(h.hexdigest())
+
+        hasher = threading.Thread(target=_hasher, daemon=True)
+        hasher.start()
         try:
             with open(temp_path, 'wb') as cache_file:
-                for chunk in up_resp.iter_content(chunk_size=1024*1024):
+                # 已知长度时预分配：一次性拿到连续 extent，
+                # 避免边写边扩展导致的碎片和元数据更新
+                if content_length and hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(cache_file.fileno(), 0, int(content_length))
+                    except OSError:
+                        pass
+                for chunk in up_resp.iter_content(chunk_size=UPSTREAM_CHUNK):
                     if chunk:
+                        hq.put(chunk)
                         cache_file.write(chunk)
-                        h.update(chunk)
                         yield chunk
-            
-            # 下载完成，原子替换
-            sha_val = h.hexdigest()
+                # 实际字节数可能少于预分配长度，裁掉多余部分
+                cache_file.truncate()
+
+            # 下载完成，等哈希线程收尾后原子替换
+            hq.put(None)
+            hasher.join()
+            sha_val = digest_holder[0]
             os.rename(temp_path, local_cache_path)
-            with open(local_cache_path + ".sha256", "w") as f:
-                f.write(sha_val)
-            print(f"[+] [CACHE] Cached XetHub file: {local_cache_path}")
-        except Exception as e:
-            print(f"[ERROR] Cache write failed: {e}")
+            _store_hash(local_cache_path, sha_val)
+            if not h.sampled:
+                _dedup_into_cas(local_cache_path, sha_val)
+            _record_publish(local_cache_path)
+            log.info("[CACHE] Cached XetHub file: %s", local_cache_path)
+        except Exception:
+            log.exception("Cache write failed: %s", local_cache_path)
+            hq.put(None)
             if os.path.exists(temp_path):
                 os.remove(temp_path)
             # 继续 yield 剩余数据，不影响客户端下载
-            for chunk in up_resp.iter_content(chunk_size=1024*1024):
+            for chunk in up_resp.iter_content(chunk_size=UPSTREAM_CHUNK):
                 if chunk:
                     yield chunk
     
@@ -150,32 +233,29 @@ def dynamic_proxy(protocol, domain=None, path=None):
         real_url = f"{protocol}://{domain}/{path}"
     
     range_header = request.headers.get('Range')
-    print(f"\n{'='*60}")
-    print(f"[*] [LFS] {request.method} {real_url[:100]}...")
-    print(f"[*] [LFS] Range: {range_header}")
-    print(f"[*] [LFS] Domain: {domain}")
+    log.info("[LFS] %s %s... (Range: %s)", request.method, real_url[:100], range_header)
 
     cache_key_path = os.path.join(domain, path)
     local_file_path = os.path.join(CACHE_ROOT, cache_key_path)
 
     # 检查本地缓存（对所有类型的 URL 都适用）
     if os.path.exists(local_file_path):
-        print(f"[*] [CACHE] Serving from cache: {local_file_path}")
+        log.info("[CACHE] Serving from cache: %s", local_file_path)
+        _record_hit(local_file_path)
         if request.method == 'HEAD':
             size = os.path.getsize(local_file_path)
             resp = Response(status=200)
             resp.headers['Content-Length'] = str(size)
             resp.headers['Accept-Ranges'] = 'bytes'
-            sha_path = local_file_path + ".sha256"
-            if os.path.exists(sha_path):
-                with open(sha_path, 'r') as f:
-                    resp.headers['ETag'] = f'"{f.read().strip()}"'
+            sha_val = _load_hash(local_file_path)
+            if sha_val:
+                resp.headers['ETag'] = f'"{sha_val}"'
             return resp
         return serve_local_file(local_file_path, range_header)
 
     # XetHub：带缓存的代理（边下载边缓存）
     if is_xethub_url(domain):
-        print(f"[*] [LFS] XetHub detected, proxy with cache")
+        log.debug("[LFS] XetHub detected, proxy with cache")
         if request.method == 'GET' and not range_header:
             return proxy_to_upstream_with_cache(real_url, request.method, local_file_path)
         return proxy_to_upstream(real_url, request.method)
@@ -187,96 +267,524 @@ def dynamic_proxy(protocol, domain=None, path=None):
     return proxy_to_upstream(real_url, request.method)
 
 def trigger_background_download(url, local_path):
-    with download_locks:
-        if local_path in active_downloads:
-            return
-        if os.path.exists(local_path):
-            return
-        active_downloads.add(local_path)
-        print(f"[*] [CACHE] Triggering background download for: {url}")
-        t = threading.Thread(target=robust_download, args=(url, local_path))
-        t.daemon = True
-        t.start()
+    if local_path in _inflight or os.path.exists(local_path):
+        return
+    # 先用占位符抢注，再提交任务：submit 在前的话池子里的 worker
+    # 可能赶在去重判断前就开跑，两个请求同时写同一个 .tmp
+    placeholder = object()
+    if _inflight.setdefault(local_path, placeholder) is not placeholder:
+        # 另一个请求刚抢先注册了同一路径
+        return
+    fut = _dl_pool.submit(robust_download, url, local_path)
+    _inflight[local_path] = fut
+    fut.add_done_callback(lambda _, k=local_path: _inflight.pop(k, None))
+    log.info("[CACHE] Triggering background download for: %s", url)
 
 def robust_download(url, local_path):
     try:
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         temp_path = local_path + ".tmp"
-        
-        cmd = ["curl", "-L", "-s", "-o", temp_path, url]
-        if OUTBOUND_PROXY:
-            cmd.extend(["-x", OUTBOUND_PROXY])
-        
-        print(f"[*] [CACHE] Starting: {url}")
-        result = subprocess.run(cmd, timeout=1200)
-        
-        if result.returncode == 0 and os.path.exists(temp_path):
-            h = hashlib.sha256()
-            with open(temp_path, "rb") as f:
-                while True:
-                    chunk = f.read(1024 * 1024)
-                    if not chunk:
-                        break
+
+        log.info("[CACHE] Starting: %s", url)
+        with _bg_session.get(
+            url,
+            stream=True,
+            proxies=get_proxies(),
+            timeout=1200,
+            verify=False,
+        ) as r:
+            r.raise_for_status()
+            # 边下边哈希，省掉下载完成后对整个文件的第二次读
+            cl = r.headers.get('Content-Length')
+            h = _SampledHasher(int(cl) if cl else None)
+            with open(temp_path, "wb") as f:
+                while chunk := r.raw.read(LOCAL_CHUNK):
+                    f.write(chunk)
                     h.update(chunk)
-            sha_val = h.hexdigest()
-            
-            os.rename(temp_path, local_path)
-            with open(local_path + ".sha256", "w") as mf:
-                mf.write(sha_val)
-            print(f"[+] [CACHE] Done: {local_path}")
+        sha_val = h.hexdigest()
+
+        _durable_rename(temp_path, local_path)
+        _store_hash(local_path, sha_val)
+        if not h.sampled:
+            _dedup_into_cas(local_path, sha_val)
+        _record_publish(local_path)
+        log.info("[CACHE] Done: %s", local_path)
+    except Exception:
+        log.exception("[CACHE] Download failed: %s", url)
+        temp_path = local_path + ".tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# 完整性哈希统一入口。CPython 的 hashlib 由 OpenSSL 提供实现，
+# 运行时已自动分派 SHA-NI 硬件指令；usedforsecurity=False 允许
+# 部分发行版选择更快的 provider。
+try:
+    hashlib.sha256(usedforsecurity=False)
+
+    def _new_sha256():
+        return hashlib.sha256(usedforsecurity=False)
+except TypeError:
+    def _new_sha256():
+        return hashlib.sha256()
+
+# 采样哈希参数：这里的哈希只当缓存标识 / ETag 用，上游本就 verify=False，
+# 不构成安全边界。对几十 GB 的 blob 做全量 SHA-256 纯属浪费，
+# 默认只采样首块 + 尾块 + N 个等距 1 MiB 块；VERIFY_FULL_SHA=1 强制全量
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_SAMPLE_BLOCKS = int(os.environ.get("HASH_SAMPLE_BLOCKS", 30))
+VERIFY_FULL_SHA = bool(os.environ.get("VERIFY_FULL_SHA"))
+
+class _SampledHasher:
+    """流式采样 Merkle 哈希，接口与 hashlib 对齐（update/hexdigest）。
+
+    已知总长时预先选定要采样的块号，update 只喂落在采样块内的字节，
+    每块独立 SHA-256；hexdigest 把总长和各块摘要串起来再哈希一次作为根。
+    长度未知、文件太小或 VERIFY_FULL_SHA=1 时退化为普通全量 SHA-256。
+    """
+
+    def __init__(self, total_size=None):
+        min_sampled = (HASH_SAMPLE_BLOCKS + 2) * HASH_BLOCK_SIZE
+        if VERIFY_FULL_SHA or not total_size or total_size <= min_sampled:
+            self._full = _new_sha256()
+            self._wanted = None
         else:
-            print(f"[!] [CACHE] Failed: {url}")
-    except Exception as e:
-        print(f"[ERROR] {e}")
+            self._full = None
+            nb = (total_size + HASH_BLOCK_SIZE - 1) // HASH_BLOCK_SIZE
+            wanted = {0, nb - 1}
+            wanted.update((i * (nb - 1)) // (HASH_SAMPLE_BLOCKS + 1)
+                          for i in range(1, HASH_SAMPLE_BLOCKS + 1))
+            self._wanted = wanted
+        self._pos = 0
+        self._hashers = {}
+
+    @property
+    def sampled(self):
+        """采样摘要不覆盖全部字节，不同内容可能同值，
+        只能当 ETag 用，不能做 CAS 去重这类内容寻址的键"""
+        return self._full is None
+
+    def update(self, chunk):
+        if self._full is not None:
+            self._full.update(chunk)
+            return
+        start = self._pos
+        self._pos += len(chunk)
+        if not chunk:
+            return
+        mv = memoryview(chunk)
+        end = self._pos
+        for blk in range(start // HASH_BLOCK_SIZE, (end - 1) // HASH_BLOCK_SIZE + 1):
+            if blk not in self._wanted:
+                continue
+            b0 = blk * HASH_BLOCK_SIZE
+            h = self._hashers.get(blk)
+            if h is None:
+                h = self._hashers[blk] = _new_sha256()
+            h.update(mv[max(start, b0) - start:min(end, b0 + HASH_BLOCK_SIZE) - start])
+
+    def hexdigest(self):
+        if self._full is not None:
+            return self._full.hexdigest()
+        root = _new_sha256()
+        root.update(str(self._pos).encode())
+        for blk in sorted(self._hashers):
+            root.update(self._hashers[blk].digest())
+        return root.hexdigest()
+
+def _fsync_dir(dir_path):
+    fd = os.open(dir_path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _durable_rename(tmp_path, final_path):
+    """崩溃安全发布：fsync 数据 -> rename -> fsync 父目录
+    否则崩溃可能留下数据文件但没有 .sha256，缓存命中检查失效后会整个重下"""
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
     finally:
-        with download_locks:
-            if local_path in active_downloads:
-                active_downloads.remove(local_path)
+        os.close(fd)
+    os.rename(tmp_path, final_path)
+    _fsync_dir(os.path.dirname(final_path))
+
+def _durable_write(path, text):
+    """sidecar 小文件走 tmp + fsync + rename"""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    _fsync_dir(os.path.dirname(path))
+
+def _store_hash(path, sha_val):
+    """哈希优先存在 user.sha256 xattr 里：跟着 inode 走，
+    rename/备份不丢，目录里也少一半小文件。文件系统不支持时回退 sidecar"""
+    if hasattr(os, "setxattr"):
+        try:
+            os.setxattr(path, "user.sha256", sha_val.encode())
+            return
+        except OSError:
+            pass
+    _durable_write(path + ".sha256", sha_val)
+
+def _dedup_into_cas(path, sha_val):
+    """按内容寻址去重：同一 blob 从不同 URL 再次缓存时只占一份磁盘。
+
+    哈希算完后把数据文件硬链接进 CACHE_ROOT/_cas/<sha[:2]>/<sha>；
+    CAS 里已有同哈希条目时，改用它的硬链接替换刚写的文件。
+    """
+    cas_path = os.path.join(CACHE_ROOT, "_cas", sha_val[:2], sha_val)
+    try:
+        if os.path.exists(cas_path):
+            # 共享已有 blob 的 inode，释放重复数据
+            tmp = path + ".link"
+            os.link(cas_path, tmp)
+            os.replace(tmp, path)
+        else:
+            os.makedirs(os.path.dirname(cas_path), exist_ok=True)
+            os.link(path, cas_path)
+    except FileExistsError:
+        # 并发缓存同一哈希，CAS 条目已就位
+        pass
+    except OSError:
+        # 跨设备 / 文件系统不支持硬链接，放弃去重不影响正确性
+        pass
+
+# download.py 装了 blake3 时写 .blake3 sidecar 到同一棵缓存树，
+# 读取和淘汰都要两种后缀一起认，否则这些文件丢 ETag、清理时留孤儿
+_HASH_SIDECAR_EXTS = (".sha256", ".blake3")
+
+def _load_hash(path):
+    """读取文件哈希：先试 xattr，再逐个试 sidecar 后缀，都没有返回 None"""
+    if hasattr(os, "getxattr"):
+        try:
+            return os.getxattr(path, "user.sha256").decode()
+        except OSError:
+            pass
+    for ext in _HASH_SIDECAR_EXTS:
+        try:
+            with open(path + ext, "r") as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+# 缓存元数据：每个条目的命中数 / 最近使用 / 大小，供 janitor 做淘汰决策。
+# 超过水位线后按策略清理，缓存不再无限增长（此前只靠 10TiB 微信告警人工处理）
+_META_DB = os.path.join(CACHE_ROOT, "_meta.db")
+CACHE_WATERMARK = int(os.environ.get("CACHE_WATERMARK", 10 * 1024 ** 4))
+EVICT_POLICY = os.environ.get("EVICT_POLICY", "lfu")
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", 600))
+
+# 淘汰顺序可插拔：lfu 先踢只被拉过一两次的冷 blob（循环型负载下
+# 纯 LRU 会误杀热点）；lru 纯按时间；2q 近似——只命中过一次的先进试用队列
+_EVICT_ORDER = {
+    "lfu": "hits ASC, last_used ASC",
+    "lru": "last_used ASC",
+    "2q": "(hits > 1) ASC, last_used ASC",
+}
+
+_meta_local = threading.local()
+
+def _get_meta_db():
+    """sqlite 连接不能跨线程，按线程各建一个，WAL 模式读写互不阻塞"""
+    conn = getattr(_meta_local, "conn", None)
+    if conn is None:
+        os.makedirs(CACHE_ROOT, exist_ok=True)
+        conn = sqlite3.connect(_META_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            "path TEXT PRIMARY KEY, "
+            "hits INTEGER NOT NULL DEFAULT 0, "
+            "last_used REAL NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "ino INTEGER)"
+        )
+        try:
+            # 旧库升级：按 inode 统计用量需要 ino 列
+            conn.execute("ALTER TABLE meta ADD COLUMN ino INTEGER")
+        except sqlite3.OperationalError:
+            pass
+        conn.commit()
+        _meta_local.conn = conn
+    return conn
+
+def _record_hit(path):
+    """命中登记：utime 刷新 atime（文件系统层的廉价信号），sqlite 里 hits+1"""
+    try:
+        os.utime(path, None)
+        st = os.stat(path)
+        db = _get_meta_db()
+        db.execute(
+            "INSERT INTO meta (path, hits, last_used, size, ino) VALUES (?, 1, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET "
+            "hits = hits + 1, last_used = excluded.last_used, ino = excluded.ino",
+            (path, time.time(), st.st_size, st.st_ino),
+        )
+        db.commit()
+    except (OSError, sqlite3.Error):
+        # 统计失败不能影响响应
+        log.debug("record_hit failed for %s", path, exc_info=True)
+
+def _record_publish(path):
+    """发布即登记：新落盘的条目立刻进表（hits=0），
+    否则从未被命中的 blob 不占统计、水位线永远不触发，也永远淘汰不掉"""
+    try:
+        st = os.stat(path)
+        db = _get_meta_db()
+        db.execute(
+            "INSERT INTO meta (path, hits, last_used, size, ino) VALUES (?, 0, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET size = excluded.size, ino = excluded.ino",
+            (path, time.time(), st.st_size, st.st_ino),
+        )
+        db.commit()
+    except (OSError, sqlite3.Error):
+        log.debug("record_publish failed for %s", path, exc_info=True)
+
+# 对账时不登记的文件：sidecar / 元数据 / 各种中间文件
+_META_SKIP_SUFFIXES = (".sha256", ".blake3", ".tmp", ".meta", ".link")
+
+def _reconcile_meta(db):
+    """把表和磁盘对齐：download.py 等进程绕过代理直接往 CACHE_ROOT 写，
+    这些文件要补进表里（hits=0，last_used 取 mtime）才能参与淘汰；
+    已被删掉的文件对应的行一并清除"""
+    seen = set()
+    cas_root = os.path.join(CACHE_ROOT, "_cas")
+    stack = [CACHE_ROOT]
+    while stack:
+        p = stack.pop()
+        try:
+            with os.scandir(p) as it:
+                for entry in it:
+                    try:
+                        if entry.is_symlink():
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.path != cas_root:
+                                stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            name = entry.name
+                            if name.endswith(_META_SKIP_SUFFIXES) or name.startswith("_meta.db"):
+                                continue
+                            seen.add(entry.path)
+                            st = entry.stat(follow_symlinks=False)
+                            db.execute(
+                                "INSERT OR IGNORE INTO meta (path, hits, last_used, size, ino) "
+                                "VALUES (?, 0, ?, ?, ?)",
+                                (entry.path, st.st_mtime, st.st_size, st.st_ino),
+                            )
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    for (path,) in db.execute("SELECT path FROM meta").fetchall():
+        if path not in seen:
+            db.execute("DELETE FROM meta WHERE path = ?", (path,))
+    db.commit()
+
+def _evict_one(db, path, size):
+    """删除一个缓存条目及其 sidecar，返回实际释放的字节数。
+
+    硬链接去重过的 inode 要等最后一个引用消失才真正腾出磁盘；
+    CAS 条目只在没有其它缓存路径共享该 inode 时才删，
+    否则这个摘要以后就没法继续去重了。
+    """
+    sha_val = _load_hash(path)
+    try:
+        nlink = os.stat(path).st_nlink
+    except OSError:
+        nlink = 1
+    for victim in (path, *(path + ext for ext in _HASH_SIDECAR_EXTS), path + ".meta"):
+        try:
+            os.unlink(victim)
+        except OSError:
+            pass
+    freed = size if nlink <= 1 else 0
+    if sha_val:
+        cas_path = os.path.join(CACHE_ROOT, "_cas", sha_val[:2], sha_val)
+        try:
+            if os.stat(cas_path).st_nlink == 1:
+                # 只剩 CAS 自己这一个引用，inode 可以真正释放了
+                os.unlink(cas_path)
+                freed = size
+        except OSError:
+            pass
+    db.execute("DELETE FROM meta WHERE path = ?", (path,))
+    log.info("[EVICT] %s (freed %d bytes)", path, freed)
+    return freed
+
+def _janitor():
+    order = _EVICT_ORDER.get(EVICT_POLICY, _EVICT_ORDER["lfu"])
+    while True:
+        time.sleep(JANITOR_INTERVAL)
+        try:
+            db = _get_meta_db()
+            _reconcile_meta(db)
+            # 按 inode 去重统计：硬链接去重后的多条 path 行共享磁盘，
+            # 逐行 SUM(size) 会高估用量、过早触发淘汰
+            total = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM "
+                "(SELECT MAX(size) AS size FROM meta GROUP BY COALESCE(ino, path))"
+            ).fetchone()[0]
+            if total <= CACHE_WATERMARK:
+                continue
+            rows = db.execute(f"SELECT path, size FROM meta ORDER BY {order}").fetchall()
+            for path, size in rows:
+                if total <= CACHE_WATERMARK:
+                    break
+                total -= _evict_one(db, path, size)
+            db.commit()
+        except Exception:
+            log.exception("Janitor pass failed")
+
+threading.Thread(target=_janitor, daemon=True, name="cache-janitor").start()
+
+def _advise_sequential(fd):
+    """顺序读提示，让内核积极预读；不支持的平台上为 no-op"""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+# 预编译的 Range 头解析，热路径上避免 replace/split/异常开销
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+# 起点越过文件末尾：RFC 7233 要求 416，和"语法无效、忽略整头"区分开
+_RANGE_UNSATISFIABLE = object()
+
+def _parse_range(range_header, size):
+    """解析单段 Range 头。
+
+    返回 (start, end)；起点越过文件末尾返回 _RANGE_UNSATISFIABLE（416）；
+    语法无效返回 None，调用方按 RFC 7233 忽略整个头降级为 200 全量。
+    """
+    m = _RANGE_RE.match(range_header)
+    if not m:
+        return None
+    first, last = m.group(1), m.group(2)
+    if first:
+        start = int(first)
+        if start >= size:
+            return _RANGE_UNSATISFIABLE
+        end = int(last) if last else size - 1
+        if end < start:
+            return None
+        end = min(end, size - 1)
+    elif last:
+        # 后缀范围：bytes=-N 表示最后 N 字节；-0 是无效写法
+        n = int(last)
+        if n == 0:
+            return None
+        if size == 0:
+            return _RANGE_UNSATISFIABLE
+        start = max(0, size - n)
+        end = size - 1
+    else:
+        return None
+    return start, end
+
+class _RangeReader:
+    """限制读取窗口的文件包装。
+
+    保留 fileno/tell，gunicorn 的 wsgi.file_wrapper 识别后用
+    sendfile 在内核态直发 [start, start+length) 区间。
+    """
+
+    def __init__(self, f, start, length):
+        self._f = f
+        self._remaining = length
+        f.seek(start)
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def tell(self):
+        return self._f.tell()
+
+    def read(self, n=-1):
+        if self._remaining <= 0:
+            return b""
+        if n < 0 or n > self._remaining:
+            n = self._remaining
+        data = self._f.read(n)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
 
 def serve_local_file(path, range_header):
     size = os.path.getsize(path)
-    if range_header:
-        try:
-            ranges = range_header.replace('bytes=', '').split('-')
-            if ranges[0]:
-                start = int(ranges[0])
-                end = int(ranges[1]) if (len(ranges) > 1 and ranges[1]) else size - 1
-            else:
-                end = size - 1
-                start = size - int(ranges[1])
-            
-            start = max(0, min(start, size - 1))
-            end = max(start, min(end, size - 1))
-            
-            def gen():
-                with open(path, "rb") as f:
-                    f.seek(start)
-                    rem = end - start + 1
-                    while rem > 0:
-                        chunk = f.read(min(1024*1024, rem))
-                        if not chunk: break
-                        yield chunk
-                        rem -= len(chunk)
-            res = Response(gen(), status=206, content_type="application/octet-stream")
+
+    # nginx 直发：X-Accel-Redirect 后由 nginx 处理 Range/sendfile
+    if ACCEL_REDIRECT_PREFIX:
+        res = Response(status=200, content_type="application/octet-stream")
+        rel = os.path.relpath(path, CACHE_ROOT)
+        res.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + rel
+        return res
+
+    # 多段 Range 合法但这里不支持，按 RFC 7233 忽略整个头走 200 全量；
+    # 语法无效的头（_parse_range 返回 None）同样忽略
+    ignored_range = bool(range_header)
+    if range_header and ',' not in range_header:
+        parsed = _parse_range(range_header, size)
+        if parsed is _RANGE_UNSATISFIABLE:
+            log.warning("[LFS] Unsatisfiable range %s", range_header)
+            res = Response(status=416)
+            res.headers['Content-Range'] = f'bytes */{size}'
+            res.headers['Accept-Ranges'] = 'bytes'
+            return res
+        elif parsed is not None:
+            start, end = parsed
+            f = open(path, "rb")
+            _advise_sequential(f.fileno())
+            reader = _RangeReader(f, start, end - start + 1)
+            body = wrap_file(request.environ, reader, LOCAL_CHUNK)
+            res = Response(body, status=206, direct_passthrough=True,
+                           content_type="application/octet-stream")
             res.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
             res.headers['Content-Length'] = str(end - start + 1)
             res.headers['Accept-Ranges'] = 'bytes'
             return res
-        except Exception as e:
-            print(f"[!] [LFS] Error parsing range {range_header}: {e}")
-    
+
+    if not SERVE_FULL_PY:
+        # send_file 走 WSGI 的 file_wrapper（gunicorn 下是 sendfile），
+        # 数据在内核态直达 socket，不再逐块经过解释器。
+        # 被我们忽略的 Range 头不能再交给 conditional 处理，
+        # 否则 werkzeug 重新解析后又对它回 416
+        res = send_file(path, mimetype="application/octet-stream",
+                        conditional=not ignored_range)
+        if ignored_range:
+            res.headers['Content-Length'] = str(size)
+        res.headers['Accept-Ranges'] = 'bytes'
+        return res
+
     def gen_full():
+        # mmap 后直接切片：从页缓存单次拷贝成 bytes，没有 read 的
+        # 用户态缓冲中转。PEP 3333 要求产出 bytes，gunicorn 对
+        # memoryview 会直接 TypeError，所以这里不能做零拷贝切片
+        if size == 0:
+            return
         with open(path, "rb") as f:
-            while c := f.read(1024*1024): 
-                yield c
+            _advise_sequential(f.fileno())
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for off in range(0, size, LOCAL_CHUNK):
+                    yield mm[off:off + LOCAL_CHUNK]
     res = Response(gen_full(), status=200, content_type="application/octet-stream")
     res.headers['Content-Length'] = str(size)
     res.headers['Accept-Ranges'] = 'bytes'
     return res
 
 if __name__ == '__main__':
+    # 开发模式入口；生产环境用 gunicorn 跑 scripts/wsgi.py
     port = int(os.environ.get("CACHE_PROXY_PORT", 50001))
     print(f"[*] Starting LFS proxy on port {port}")
     print(f"[*] Cache root: {CACHE_ROOT}")
     print(f"[*] Outbound proxy: {OUTBOUND_PROXY or 'None'}")
-    app.run(host='0.0.0.0', port=port, threaded=True, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, threaded=True)
\ No newline at end of file
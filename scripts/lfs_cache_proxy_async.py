@@ -0,0 +1,273 @@
+"""
+lfs_cache_proxy_async.py
+lfs_cache_proxy.py 的异步版本：单个事件循环承载大量并发 LFS 流。
+
+Flask/WSGI 每个在途流占用一个 OS 线程并阻塞在 socket 读上；
+这里用 aiohttp 的事件循环复用 socket，数千个并发流共享一个线程。
+
+缓存命中直接走 web.FileResponse（内核 sendfile，自带 Range 支持）；
+未命中流式透传上游，XetHub 的完整 GET 同时边透传边写缓存，
+普通 CDN-LFS 的 GET 触发后台整文件下载进缓存（与同步版一致），
+磁盘写和哈希丢进默认线程池，事件循环只搬运 socket 数据。
+
+运行：python scripts/lfs_cache_proxy_async.py
+"""
+import os
+import asyncio
+import hashlib
+
+import aiohttp
+from aiohttp import web
+
+CACHE_ROOT = os.environ.get("CACHE_ROOT", "./hf_cache")
+OUTBOUND_PROXY = os.environ.get("OUTBOUND_PROXY", "http://127.0.0.1:6666")  # 可以设为空来测试
+
+UPSTREAM_CHUNK = int(os.environ.get("UPSTREAM_CHUNK", 256 * 1024))
+
+# 转发时需要剔除的头
+_SKIP_REQ_HEADERS = frozenset({'host', 'content-length', 'transfer-encoding'})
+_SKIP_RESP_HEADERS = frozenset({'content-encoding', 'transfer-encoding', 'connection'})
+
+_session = None
+
+try:
+    hashlib.sha256(usedforsecurity=False)
+
+    def _new_sha256():
+        return hashlib.sha256(usedforsecurity=False)
+except TypeError:
+    def _new_sha256():
+        return hashlib.sha256()
+
+
+def is_xethub_url(domain):
+    """检查是否是 XetHub 的 URL（与同步版一致）"""
+    return domain and ('xethub' in domain or 'cas-bridge' in domain)
+
+
+def _fsync_dir(dir_path):
+    fd = os.open(dir_path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_and_hash(f, h, chunk):
+    f.write(chunk)
+    h.update(chunk)
+
+
+def _publish(temp_path, final_path, sha_val):
+    """阻塞的落盘收尾：fsync -> rename -> 哈希进 xattr（不支持则回退 sidecar）"""
+    fd = os.open(temp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(temp_path, final_path)
+    _fsync_dir(os.path.dirname(final_path))
+    # macOS 上没有 os.setxattr，和同步版一样先 hasattr 再调
+    if hasattr(os, "setxattr"):
+        try:
+            os.setxattr(final_path, "user.sha256", sha_val.encode())
+            return
+        except OSError:
+            pass
+    with open(final_path + ".sha256", "w") as f:
+        f.write(sha_val)
+
+
+def _load_hash(path):
+    if hasattr(os, "getxattr"):
+        try:
+            return os.getxattr(path, "user.sha256").decode()
+        except OSError:
+            pass
+    # download.py 装了 blake3 时写 .blake3 sidecar，两种后缀都认
+    for ext in (".sha256", ".blake3"):
+        try:
+            with open(path + ext, "r") as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+# 正在后台下载的 local_path -> Task
+# 事件循环单线程，检查和注册之间不会被并发请求打断
+_inflight = {}
+
+
+async def _background_download(url, local_path):
+    """普通 CDN-LFS 的后台整文件下载（对应同步版的 robust_download）"""
+    temp_path = local_path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        session = await _get_session()
+        loop = asyncio.get_running_loop()
+        h = _new_sha256()
+        async with session.get(url, proxy=OUTBOUND_PROXY or None) as r:
+            r.raise_for_status()
+            with open(temp_path, 'wb') as f:
+                async for chunk in r.content.iter_chunked(UPSTREAM_CHUNK):
+                    await loop.run_in_executor(None, _write_and_hash, f, h, chunk)
+        await loop.run_in_executor(None, _publish, temp_path, local_path, h.hexdigest())
+        print(f"[+] [CACHE] Done: {local_path}")
+    except Exception as e:
+        print(f"[ERROR] Background download failed: {url}: {e}")
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+    finally:
+        _inflight.pop(local_path, None)
+
+
+def trigger_background_download(url, local_path):
+    if local_path in _inflight or os.path.exists(local_path):
+        return
+    _inflight[local_path] = asyncio.get_running_loop().create_task(
+        _background_download(url, local_path))
+
+
+async def _get_session():
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300),
+            connector=aiohttp.TCPConnector(limit=256, ssl=False),
+        )
+    return _session
+
+
+def _filter_request_headers(request, netloc):
+    headers = {k: v for k, v in request.headers.items()
+               if k.lower() not in _SKIP_REQ_HEADERS}
+    headers['Host'] = netloc
+    return headers
+
+
+async def proxy_to_upstream(request, real_url, domain, local_cache_path=None):
+    """流式透传上游响应，可选边透传边落盘"""
+    session = await _get_session()
+    async with session.request(
+        request.method, real_url,
+        headers=_filter_request_headers(request, domain),
+        proxy=OUTBOUND_PROXY or None,
+        allow_redirects=False,
+    ) as up_resp:
+        resp_headers = {k: v for k, v in up_resp.headers.items()
+                        if k.lower() not in _SKIP_RESP_HEADERS}
+
+        if request.method == 'HEAD':
+            return web.Response(status=up_resp.status, headers=resp_headers)
+
+        if local_cache_path and up_resp.status == 200:
+            return await _stream_and_cache(request, up_resp, resp_headers, local_cache_path)
+
+        resp = web.StreamResponse(status=up_resp.status, headers=resp_headers)
+        await resp.prepare(request)
+        async for chunk in up_resp.content.iter_chunked(UPSTREAM_CHUNK):
+            await resp.write(chunk)
+        await resp.write_eof()
+        return resp
+
+
+async def _stream_and_cache(request, up_resp, resp_headers, local_cache_path):
+    """边流式返回响应，边写入缓存文件。
+
+    write/hash 是阻塞调用，经 run_in_executor 交给默认线程池，
+    事件循环在此期间继续服务其它流；缓存写失败只放弃落盘，
+    客户端继续收剩余数据。
+    """
+    os.makedirs(os.path.dirname(local_cache_path), exist_ok=True)
+    temp_path = local_cache_path + ".tmp"
+    loop = asyncio.get_running_loop()
+
+    resp = web.StreamResponse(status=up_resp.status, headers=resp_headers)
+    await resp.prepare(request)
+
+    h = _new_sha256()
+    cache_file = open(temp_path, 'wb')
+    caching = True
+    try:
+        async for chunk in up_resp.content.iter_chunked(UPSTREAM_CHUNK):
+            await resp.write(chunk)
+            if caching:
+                try:
+                    await loop.run_in_executor(None, _write_and_hash, cache_file, h, chunk)
+                except OSError:
+                    caching = False
+        if caching:
+            cache_file.close()
+            await loop.run_in_executor(
+                None, _publish, temp_path, local_cache_path, h.hexdigest())
+            print(f"[+] [CACHE] Cached: {local_cache_path}")
+    finally:
+        if not cache_file.closed:
+            cache_file.close()
+        if os.path.exists(temp_path):
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+    await resp.write_eof()
+    return resp
+
+
+async def dynamic_proxy(request):
+    protocol = request.match_info['protocol']
+    domain = request.match_info['domain']
+    path = request.match_info['path']
+    if not domain or not path:
+        return web.Response(status=400, text="Invalid path")
+
+    query_string = request.query_string
+    if query_string:
+        real_url = f"{protocol}://{domain}/{path}?{query_string}"
+    else:
+        real_url = f"{protocol}://{domain}/{path}"
+
+    local_file_path = os.path.join(CACHE_ROOT, domain, path)
+
+    # 缓存命中：FileResponse 自带 Range/sendfile 支持
+    if os.path.exists(local_file_path):
+        headers = {'Accept-Ranges': 'bytes'}
+        sha_val = _load_hash(local_file_path)
+        if sha_val:
+            headers['ETag'] = f'"{sha_val}"'
+        return web.FileResponse(local_file_path, chunk_size=UPSTREAM_CHUNK, headers=headers)
+
+    # XetHub 的完整 GET：边透传边缓存（与同步版一致）
+    if is_xethub_url(domain):
+        if request.method == 'GET' and 'Range' not in request.headers:
+            return await proxy_to_upstream(request, real_url, domain, local_file_path)
+        return await proxy_to_upstream(request, real_url, domain)
+
+    # 普通 CDN-LFS：后台整文件下载进缓存
+    if request.method == 'GET':
+        trigger_background_download(real_url, local_file_path)
+
+    return await proxy_to_upstream(request, real_url, domain)
+
+
+async def _on_cleanup(app):
+    if _session is not None:
+        await _session.close()
+
+
+def make_app():
+    app = web.Application()
+    app.router.add_route('GET', '/proxy/{protocol}/{domain}/{path:.*}', dynamic_proxy)
+    app.router.add_route('HEAD', '/proxy/{protocol}/{domain}/{path:.*}', dynamic_proxy)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get("CACHE_PROXY_PORT", 50001))
+    print(f"[*] Starting async LFS proxy on port {port}")
+    print(f"[*] Cache root: {CACHE_ROOT}")
+    print(f"[*] Outbound proxy: {OUTBOUND_PROXY or 'None'}")
+    web.run_app(make_app(), host='0.0.0.0', port=port)
@@ -10,6 +10,7 @@ import sys
 import os
 import shutil
 import requests
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 NODE = "Adrastea" # Adrastea or Pear
 DOWNLOAD_SCRIPT = "./scripts/hf_download.py"
@@ -20,17 +21,34 @@ WECHAT_WEBHOOK_URL = "https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=d8255
 CACHE_SIZE_THRESHOLD = 10 * (1024 ** 4)
 _threshold_notified = False
 
+# 顶层子目录大小缓存：path -> (mtime, size)
+# 每次重试后只重算有变化的子树，而不是整个 10TB 缓存
+SIZE_RESEED_EVERY = 50
+_size_cache = {}
+_size_check_count = 0
+
 
 def get_dir_size(path):
+    # os.scandir 复用 DirEntry 缓存的 stat，免去 isfile/islink/getsize
+    # 每文件三次额外 stat；显式栈避免深层目录递归
     total = 0
-    try:
-        for dirpath, _, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                if os.path.isfile(fp) and not os.path.islink(fp):
-                    total += os.path.getsize(fp)
-    except Exception:
-        pass
+    stack = [path]
+    while stack:
+        p = stack.pop()
+        try:
+            with os.scandir(p) as it:
+                for entry in it:
+                    try:
+                        if entry.is_symlink():
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
     return total
 
 
@@ -50,16 +68,81 @@ def send_wechat_notification(message):
         print(f"[!] 通知发送失败: {e}")
 
 
+def get_cache_size_cached(cache_path, force_rescan=False):
+    total = 0
+    seen = set()
+    try:
+        with os.scandir(cache_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                        continue
+                    seen.add(entry.path)
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                    cached = _size_cache.get(entry.path)
+                    if cached is not None and cached[0] == mtime and not force_rescan:
+                        total += cached[1]
+                    else:
+                        size = get_dir_size(entry.path)
+                        _size_cache[entry.path] = (mtime, size)
+                        total += size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    for k in list(_size_cache):
+        if k not in seen:
+            del _size_cache[k]
+    return total
+
+
 def check_cache_size_and_notify():
-    global _threshold_notified
+    global _threshold_notified, _size_check_count
     if _threshold_notified:
         return
-    size = get_dir_size(os.path.abspath(CACHE_DIR))
+    cache_path = os.path.abspath(CACHE_DIR)
+    if not os.path.exists(cache_path):
+        return
+    _size_check_count += 1
+    force = (_size_check_count % SIZE_RESEED_EVERY == 0)
+    size = get_cache_size_cached(cache_path, force_rescan=force)
     if size >= CACHE_SIZE_THRESHOLD:
         send_wechat_notification(f"机器: {NODE}\n已下载超过10T\n当前大小: {format_size(size)}")
         _threshold_notified = True
 
 
+def _run_one(dataset_id):
+    """重试单个数据集（在子进程里跑），返回 (dataset_id, 是否成功)"""
+    local_dir = os.path.join(LOCAL_DIR_ROOT, dataset_id.replace("/", os.sep))
+    cmd = [
+        sys.executable, DOWNLOAD_SCRIPT,
+        dataset_id,
+        "--repo-type", "dataset",
+        "--cache-dir", CACHE_DIR,
+        "--local-dir", local_dir,
+    ]
+    if TOKEN:
+        cmd.extend(["--token", TOKEN])
+
+    print(f"\n[*] 重试: {dataset_id}")
+    try:
+        result = subprocess.run(cmd, timeout=7200)
+        ok = result.returncode == 0
+        if ok:
+            print(f"[+] 成功: {dataset_id}")
+    except Exception:
+        ok = False
+    # 无论成败都删除 local-dir；rmtree 在子进程里跑，不占主循环
+    if os.path.exists(local_dir):
+        shutil.rmtree(local_dir)
+        if ok:
+            print(f"[+] 已删除本地目录: {local_dir}")
+    return dataset_id, ok
+
+
 def main():
     if not os.path.exists("./scripts/failed_datasets.json"):
         print("[+] 没有失败的数据集需要重试")
@@ -70,38 +153,20 @@ def main():
 
     print(f"[*] 重试 {len(failed)} 个失败的数据集...")
 
+    # 各数据集互不依赖，下载是 I/O 密集型，用进程池并行重试；
+    # 缓存大小检查带全局状态，留在父进程里做
+    workers = int(os.environ.get("RETRY_PAR", 4))
     still_failed = []
-    for dataset_id in failed:
-        local_dir = os.path.join(LOCAL_DIR_ROOT, dataset_id.replace("/", os.sep))
-        cmd = [
-            sys.executable, DOWNLOAD_SCRIPT,
-            dataset_id,
-            "--repo-type", "dataset",
-            "--cache-dir", CACHE_DIR,
-            "--local-dir", local_dir,
-        ]
-        if TOKEN:
-            cmd.extend(["--token", TOKEN])
-
-        print(f"\n[*] 重试: {dataset_id}")
-        try:
-            result = subprocess.run(cmd, timeout=7200)
-            if result.returncode == 0:
-                print(f"[+] 成功: {dataset_id}")
-                # 删除 local-dir
-                if os.path.exists(local_dir):
-                    shutil.rmtree(local_dir)
-                    print(f"[+] 已删除本地目录: {local_dir}")
-            else:
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futs = {ex.submit(_run_one, did): did for did in failed}
+        for fut in as_completed(futs):
+            try:
+                dataset_id, ok = fut.result()
+            except Exception:
+                dataset_id, ok = futs[fut], False
+            if not ok:
                 still_failed.append(dataset_id)
-                if os.path.exists(local_dir):
-                    shutil.rmtree(local_dir)
-        except Exception:
-            still_failed.append(dataset_id)
-            if os.path.exists(local_dir):
-                shutil.rmtree(local_dir)
-
-        check_cache_size_and_notify()
+            check_cache_size_and_notify()
 
     if still_failed:
         with open("./scripts/failed_datasets.json", "w") as f:
@@ -0,0 +1,19 @@
+"""
+wsgi.py
+lfs_cache_proxy 的生产入口。
+
+Flask 自带的开发服务器是单进程的，debug 模式还会逐请求做代码重载检查；
+生产环境用 gunicorn 多进程 + gthread 线程 worker。
+
+注意不要用 gevent worker：本应用围绕真实线程设计——后台下载线程池、
+fsync 大文件、sqlite 提交、janitor 的全盘 scandir 都是阻塞的文件 I/O，
+gevent 不会 patch 这些调用，它们会卡住整个事件循环线程上的所有在途流。
+
+从仓库根目录启动，并显式指定 CACHE_ROOT，保证和开发模式的
+`python scripts/lfs_cache_proxy.py`（在仓库根目录跑）用同一棵缓存树：
+
+    CACHE_ROOT=./hf_cache gunicorn --pythonpath scripts \
+        -k gthread -w $(nproc) --threads 32 -b 0.0.0.0:50001 \
+        --timeout 1800 wsgi:app
+"""
+from lfs_cache_proxy import app  # noqa: F401